@@ -5,11 +5,13 @@
 # June 2021
 
 import sys
-import time
+import collections
 import os
-import shutil
+import stat
 import subprocess
-from urllib.parse import urlparse
+import time
+# shutil and concurrent.futures are imported where needed to keep startup
+# fast (concurrent.futures pulls in logging)
 
 UNMANAGED_RESPONSES = """    a - add to repo
     i - add file to ignore list
@@ -19,6 +21,8 @@ UNMANAGED_RESPONSES = """    a - add to repo
     p n - pass on this and everything in the nth folder
         of this path (similar to 1, 2, 3 described below)
     RETURN - if file is a directory, recurse into the directory
+    e - choose responses for this and all remaining files at once
+        in a text editor
     ? or h or other - print this help and prompt again
     1,2,3,... - add nth folder of this path to ignore list;
         if prompt is xyz/tmp/foo.test, '2' will add /xyz/tmp/
@@ -28,9 +32,13 @@ HELP = """vc - version control. A wrapper to avoid git exposure and damage.
 
 COMMAND SUMMARY
 ---------------
-vc checkout url directory [branch]
+vc checkout [--shallow | --partial] url directory [branch]
     Create a local working directory (and clone) from a URL and local 
         directory name. Configure branch as the local branch.
+    --shallow fetches only the latest commit (no history).
+    --partial fetches all history but downloads file contents only
+        when they are needed. Either one can save a lot of time and
+        space for large repos.
 vc help
     Print this help.
 vc info
@@ -44,6 +52,8 @@ vc new
 vc push
     Backup whole root directory from root to 
         root/../root-backups/timestamp/
+        (except on Windows, files unchanged since the last backup are
+        hard links to it, so they take no extra space)
     Check in (git commit -a; git push) the current files to the
          master repo.
     Always checks in files that have changed (as in git commit -a)
@@ -54,6 +64,8 @@ vc push
          x - add file's extension to the ignore list
          d - delete the file (after confirm)
          p - pass (do not add to repo, do nothing with file)
+         e - choose responses for this and all remaining files
+             at once in a text editor
          ? or h - print this help and prompt again
          1,2,3,... - add nth folder of this path to ignore list;
              if prompt is xyz/tmp/foo.test, '2' will add /xyz/tmp/
@@ -72,6 +84,9 @@ vc rm <file>
     Remove <file> from local repo and from local filesystem. Use push to
     update the master repo.
 
+Set the environment variable VC_QUIET to skip showing the branch when
+output is not to a terminal (e.g. when vc is run by a script).
+
 Note: I don't want to encourage branches, but the basics are:
 git branch new-branch-name -- create a new branch, do not change working branch
 git checkout new-branch-name -- make new-branch-name the working branch
@@ -86,116 +101,305 @@ def show_help():
     print(HELP)
 
 
-def get_root(suffix):
+def run(command, **kwargs):
+    """subprocess.run() for commands that need no input from the user.
+    stdin is /dev/null, and inherited file descriptors are not closed,
+    which saves the child a scan of all descriptors before exec (vc
+    opens none that need hiding; Python makes its own non-inheritable)."""
+    if "input" not in kwargs:
+        kwargs["stdin"] = subprocess.DEVNULL
+    return subprocess.run(command, close_fds=False, **kwargs)
+
+
+def find_root():
+    """look for the directory containing .git (a folder, or a file in the
+    case of submodules and worktrees) as git does, without running git"""
+    if "GIT_DIR" in os.environ:  # git will not look for .git, so neither do we
+        return None
+    path = os.getcwd()
+    while True:
+        if os.path.exists(os.path.join(path, ".git")):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:  # reached the top of the file system
+            return None
+        path = parent
+
+
+def get_root():
+    """return the top directory of the working tree (computed only once)"""
     global repo_root
     if not repo_root:
-        sp = subprocess.run(["git", "rev-parse", "--show-toplevel"],
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        repo_root = sp.stdout.decode("utf-8").strip()
+        repo_root = find_root()
+    if not repo_root:
+        sp = run(["git", "rev-parse", "--show-toplevel"],
+                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                 encoding="utf-8", errors="replace")
+        repo_root = sp.stdout.strip()
         if not os.path.isabs(repo_root):
             raise Exception("Could not get root for repo")
-    return repo_root + suffix
+    return repo_root
 
 
 def main():
-    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in DISPATCH:
         show_help()
         return
     # save current directory
     original_wd = os.getcwd();
     changed_wd = False
     # if we are supposed to be in a working directory tree, get some info:
-    if sys.argv[1] not in ["checkout", "new"]:
-        sp = subprocess.run(["git", "remote", "-v"],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        remotes = sp.stdout.decode("utf-8").splitlines()
-        errout = sp.stderr.decode("utf-8")
-        if len(remotes) == 2 and remotes[0].find("origin") == 0:
-            # expected in simple cases
-            remote = remotes[0]
-            loc2 = remote.find("(")
-            if loc2 < 0:
-                raise Exception("Could not make sense of remote: " + remote)
-            print("- " + remote[7 : loc2])
-        elif errout.find("fatal:") >= 0:
-            print("- error output from git:", errout, end="")
+    if command in NEEDS_REPO:
+        sp = run(["git", "remote", "-v"],
+                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # search the raw bytes; decode only what is printed:
+        remotes = sp.stdout.splitlines()
+        if len(remotes) == 2 and remotes[0].startswith(b"origin"):
+            # expected in simple cases: "origin <url> (fetch)"
+            # (url is between the first and last space; it may contain one)
+            remote = remotes[0].split(None, 1)[-1].rsplit(None, 1)
+            if len(remote) < 2:
+                raise Exception("Could not make sense of remote: " +
+                                remotes[0].decode("utf-8"))
+            print("- " + remote[0].decode("utf-8"))
+        elif sp.stderr.find(b"fatal:") >= 0:
+            print("- error output from git:", sp.stderr.decode("utf-8"),
+                  end="")
             print("- vc: Maybe you are not in a working directory.")
             return
         else:
-            for line in remotes: print("- " + remotes)
-        os.chdir(get_root(""))
+            for line in remotes:
+                print("- " + line.decode("utf-8"))
+        os.chdir(get_root())
         if original_wd != os.getcwd():
             changed_wd = True
             print("- running in repo root dir:", os.getcwd())
-    IMPLEMENTATIONS[COMMANDS.index(sys.argv[1])](sys.argv[1:])
+    DISPATCH[command](sys.argv[1:])
     
     if changed_wd:
         os.chdir(original_wd)
         print("- restored working directory to:", os.getcwd())
 
 
+def git_status():
+    """return "git status --porcelain=v2 -z" output as bytes"""
+    # --no-optional-locks: don't take index.lock to write back refreshed
+    # stat data, so this never waits on (or blocks) another git process,
+    # e.g. one started by an editor or IDE:
+    sp = run(["git", "--no-optional-locks", "status", "--porcelain=v2", "-z"],
+             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return sp.stdout
+
+
+def status_records(status):
+    """yield the NUL-terminated records of porcelain v2 status output"""
+    fields = iter(status.split(b"\0"))
+    for field in fields:
+        if field.startswith(b"2 "):  # renamed or copied: skip original path
+            next(fields, None)
+        if field:
+            yield field
+
+
+def current_branch():
+    """return the branch name, or "(detached)". Reads .git/HEAD directly
+    when it can, so no git process (or index walk) is needed."""
+    try:
+        with open(os.path.join(get_root(), ".git", "HEAD"), "rb") as head:
+            ref = head.read().strip()
+    except OSError:  # e.g. .git is a file in a worktree or submodule
+        ref = None
+    # a reftable repo keeps this placeholder in HEAD; the real one is in
+    # .git/reftable, which only git can read:
+    if ref == b"ref: refs/heads/.invalid" or \
+       os.path.isdir(os.path.join(get_root(), ".git", "reftable")):
+        ref = None
+    if ref is not None:
+        if ref.startswith(b"ref: refs/heads/"):
+            return ref[16 : ].decode("utf-8")
+        if not ref.startswith(b"ref: "):
+            return "(detached)"
+    # symbolic-ref reads one ref; unlike git status it skips the index:
+    sp = run(["git", "symbolic-ref", "--short", "-q", "HEAD"],
+             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+             encoding="utf-8", errors="replace")
+    if sp.returncode == 0:
+        return sp.stdout.strip()
+    return "(detached)"
+
+
+def ahead_behind():
+    """return (ahead, behind) commit counts relative to the upstream
+    branch, or None if there is no upstream. Unlike git status, this only
+    looks at commits, not at the working tree."""
+    sp = run(["git", "rev-list", "--left-right", "--count",
+              "@{upstream}...HEAD"],
+             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if sp.returncode != 0:
+        return None
+    behind, ahead = sp.stdout.split()
+    return int(ahead), int(behind)
+
+
 def show_branch():
-    sp = subprocess.run(["git", "status"], stdout=subprocess.PIPE)
-    # first line is main or branch name:
-    print("- " + sp.stdout.decode("utf-8").split('\n', 1)[0])
+    # scripts can set VC_QUIET to skip this when nobody will see it:
+    if not sys.stdout.isatty() and os.environ.get("VC_QUIET"):
+        return
+    branch = current_branch()
+    if branch == "(detached)":
+        print("- HEAD detached")
+    else:
+        print("- On branch", branch)
+
+
+FICLONE = 0x40049409  # Linux ioctl to share data blocks between files
+clone_supported = sys.platform.startswith("linux")
+
+
+def clone_file(src, dst):
+    """copy function for make_backup(): on file systems that support it
+    (btrfs, xfs, ...) the copy shares data blocks with the original until
+    either one is changed, so only metadata is written. Otherwise this is
+    an ordinary copy. (Hard links would be cheaper still, but then editing
+    a file in place would silently change the backup too.)"""
+    global clone_supported
+    import shutil
+    # only regular files: opening a named pipe (FIFO) would block forever,
+    # while copy2() reports it as a special file
+    if clone_supported and stat.S_ISREG(os.stat(src).st_mode):
+        import fcntl
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                cloned = True
+            except OSError:  # e.g. ext4, or backups on another device
+                clone_supported = False
+                cloned = False
+        if cloned:
+            shutil.copystat(src, dst)
+            return dst
+    return shutil.copy2(src, dst)
+
+
+# while make_backup() runs: the folder being written and the newest earlier
+# backup (or None), whose unchanged files link_file() shares:
+backup_dir = None
+previous_backup_dir = None
+
+
+def link_file(src, dst):
+    """copy function for make_backup(): if src is unchanged (same size and
+    modification time) since the previous backup, make dst a hard link to
+    the previous backup's copy, so it takes no more space; otherwise use
+    clone_file(). Links only join backups to each other, never to working
+    files, so editing a working file cannot change any backup. (Editing a
+    file inside a backup can change later backups of it, though.)"""
+    if os.path.lexists(dst):  # refreshing a backup made this same second;
+        os.remove(dst)  # don't write through a link into an older backup
+    if previous_backup_dir:
+        old = os.path.join(previous_backup_dir,
+                           os.path.relpath(dst, backup_dir))
+        try:
+            src_stat = os.stat(src)
+            old_stat = os.stat(old)
+            if src_stat.st_size == old_stat.st_size and \
+               src_stat.st_mtime_ns == old_stat.st_mtime_ns:
+                os.link(old, dst)
+                return dst
+        except OSError:  # no earlier copy, or no hard links on this disk
+            pass
+    return clone_file(src, dst)
+
+
+# file and folder names left out of backups:
+BACKUP_IGNORE = [".vs", ".git", "*.vcxproj", "CMakeFiles", "CMakeScripts",
+                 "Debug", "Release", "build", "cmake_install.cmake",
+                 "o2.build", "o2.xcodeproj", "static.cmake"]
 
 
 def make_backup():
-    backups = get_root("-backups")
-    if not os.path.isdir(backups):
-        if os.path.isfile(backups):
+    global backup_dir, previous_backup_dir
+    import shutil
+    root = get_root()
+    backups = root + "-backups"
+    try:
+        if not stat.S_ISDIR(os.stat(backups).st_mode):
             raise Exception("Unexpected file: " + backups)
+    except FileNotFoundError:
         os.mkdir(backups)
-    backup = backups + "/" + time.strftime("%Y%m%d-%H%M%S")
-    shutil.copytree(get_root(""), backup,
-                    ignore=shutil.ignore_patterns('.vs', '.git', '*.vcxproj',
-                               'CMakeFiles', 'CMakeScripts', 'Debug', 
-                               'Release', 'build', 'cmake_install.cmake',
-                               'o2.build', 'o2.xcodeproj', 'static.cmake'))
-
-
-def find_untracked(dryrun):
-    files = []
-    loc = dryrun.find("Untracked files:")
-    if loc < 0:
-        return files
-    loc = dryrun.find("\n", loc)
-    if loc < 0:
-        raise Exception("Untracked files heading, but no end-of-line")
-    loc += 1
-    while True:
-        loc2 = dryrun.find("\n", loc)
-        # terminate file list on blank line, but only after we find at 
-        # least one file:
-        if len(files) > 0 and loc2 == loc:
-            return files
-        elif loc == len(dryrun):  # no blank line, but this is the end
-            return files
-        elif loc2 < 0:
-            print("Warning: unexpected text after untracked files: |" + \
-                  dryrun[loc : ] + "|, len", len(dryrun[loc : ]))
-            return files
-        filename = dryrun[loc : loc2].strip()
-        # if line has only whitespace, treat it as empty line and return,
-        # but only after we find at least one file
-        if len(files) > 0 and len(filename) <= 0:
-            return files
-        elif len(filename) == 0:  # blank line or whitespace
-            pass
-        elif filename[0] == "(":  # assume parenthetical comment
+    backup = os.path.join(backups, time.strftime("%Y%m%d-%H%M%S"))
+    if sys.platform == "win32":
+        # robocopy copies with many threads, far faster than copytree on
+        # Windows; exit codes below 8 mean success. /R:0 /W:0 skip locked
+        # files instead of retrying (by default for days):
+        try:
+            sp = run(["robocopy", root, backup, "/E", "/MT:32", "/R:0",
+                      "/W:0", "/NFL", "/NDL", "/NJH", "/NJS", "/NP",
+                      "/XD"] + BACKUP_IGNORE + ["/XF"] + BACKUP_IGNORE,
+                     stdout=subprocess.DEVNULL)
+            if sp.returncode >= 8:
+                raise Exception("robocopy could not back up to " + backup)
+            return
+        except FileNotFoundError:  # no robocopy: use copytree
             pass
-        elif filename.find("to include in what will be committed") > 0:
-            pass  # specific check for a known comment
-        else:
-            print("Debug: adding |" + filename + "| to untracked files")
-            files.append(filename)
-        loc = loc2 + 1
+    # backup names are timestamps, so the newest sorts last:
+    earlier = [name for name in os.listdir(backups)
+               if name[ : 8].isdigit() and name != os.path.basename(backup)]
+    backup_dir = backup
+    previous_backup_dir = None
+    if earlier:
+        previous_backup_dir = os.path.join(backups, max(earlier))
+    # a second push within the same second refreshes that second's backup
+    # rather than failing with FileExistsError:
+    shutil.copytree(root, backup, copy_function=link_file,
+                    dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns(*BACKUP_IGNORE))
+
+
+def find_untracked(status):
+    # "?" marks an untracked file or folder:
+    return [os.fsdecode(record[2 : ]) for record in status_records(status)
+            if record.startswith(b"? ")]
+
+
+def write_gitignore(lines):
+    """append lines to .gitignore in one write, skipping duplicates"""
+    if len(lines) == 0:
+        return
+    gitignore = os.path.join(get_root(), ".gitignore")
+    try:
+        with open(gitignore, "r") as file_object:
+            present = set(line.strip() for line in file_object)
+    except FileNotFoundError:
+        present = set()
+    new_lines = []
+    for text in lines:  # skip duplicates, e.g. "x" twice for *.o
+        if text not in present:
+            present.add(text)
+            new_lines.append(text)
+    if len(new_lines) == 0:
+        return
+    with open(gitignore, "a") as file_object:
+        file_object.write("\n" + "\n".join(new_lines) + "\n")
+    print("- added to repo's .gitignore file:", '"' + '", "'.join(new_lines) +
+          '"')
 
 
-def add_to_gitignore(text):
-    with open(get_root("/.gitignore"), "a") as file_object:
-        file_object.write("\n" + text + "\n")
-    print('- added "' + text + '"' + " to repo's .gitignore file.")
+def add_files(files):
+    """git add files, all with one git command"""
+    if len(files) == 0:
+        return
+    paths = b"\0".join([os.fsencode(file) for file in files])
+    # --pathspec-from-file needs git 2.26 or later; older git gets the
+    # files on the command line:
+    sp = run(["git", "add", "--pathspec-from-file=-", "--pathspec-file-nul"],
+             input=paths, stderr=subprocess.DEVNULL)
+    if sp.returncode != 0:
+        sp = run(["git", "add", "--"] + files)
+    if sp.returncode != 0:
+        print("- git add failed, so these files will not be committed:",
+              ", ".join(files))
 
 
 def confirm(prompt):
@@ -203,137 +407,295 @@ def confirm(prompt):
     return inp == "Y"
 
 
-def delete_after_confirm(filepath):
-    if confirm("delete " + filepath):
-        os.remove(filepath)
-        return True
-    return False
+def list_files(path):
+    """return paths of files in directory path (ending in "/") and its
+    subdirectories, "/"-separated like paths from git status;
+    os.scandir() tells us file types without another stat() per entry"""
+    files = []
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(path + entry.name + "/")
+            else:
+                files.append(path + entry.name)
+    for folder in folders:
+        files += list_files(folder)
+    return files
+
+
+EDIT_INSTRUCTIONS = """# vc: responses for untracked files, one file per line.
+# Change the response at the start of a line to any of:
+#     a, i, x, d, p, p<n> or <n> (1, 2, 3, ...) as in the prompt,
+#     r to ask about each file in a directory.
+# Deleting a line is the same as p (pass). Lines starting with # are
+# ignored. Save the file and exit the editor to continue.
+"""
+
+def folder_prefix(folders, n):
+    """return the first n folders joined into a path ending in "/", or
+    None (after telling the user) if there are not n folders to choose"""
+    if n < 1 or len(folders) < n:
+        print("- there are not", n, "folders on path, try again")
+        return None
+    return "/".join(folders[ : n]) + "/"
+
+
+# responses chosen with "e", used by handle_untracked_file() in place of
+# prompting (invalid responses still result in a prompt):
+preset_responses = {}
+
+
+def extension(file):
+    """return the extension of file (a path from git status, so always
+    "/"-separated), including the ".", or "" if there is none"""
+    name = file[file.rfind("/") + 1 : ]
+    dot = name.rfind(".")
+    return name[dot : ] if dot > 0 else ""
+
+
+def edit_responses(files):
+    """write files with a proposed response for each to a temporary file,
+    let the user edit it, and put the results in preset_responses"""
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", suffix=".txt",
+                                     delete=False) as text_file:
+        text_file.write(EDIT_INSTRUCTIONS)
+        for file in files:
+            response = "x" if extension(file).endswith("~") else "p"
+            text_file.write(response + " " + file + "\n")
+        temp_name = text_file.name
+    # use the same editor git uses for commit messages:
+    sp = run(["git", "var", "GIT_EDITOR"], stdout=subprocess.PIPE,
+             encoding="utf-8", errors="replace")
+    editor = sp.stdout.strip()
+    if sp.returncode != 0 or editor == "" or \
+       subprocess.run(editor + ' "' + temp_name + '"',
+                      shell=True).returncode != 0:
+        # don't act on proposals the user may never have seen:
+        os.remove(temp_name)
+        print("- the editor failed, so you will be asked about each file")
+        return
+    with open(temp_name, "r") as text_file:
+        lines = text_file.read().splitlines()
+    os.remove(temp_name)
+    for file in files:
+        preset_responses[file] = "p"
+    for line in lines:
+        response, sep, file = line.partition(" ")
+        if response.startswith("#") or file not in preset_responses:
+            continue
+        preset_responses[file] = response
 
 
 pass_on_this_path = None
 
-def handle_untracked_file(file):
+def handle_untracked_file(file, queue):
+    """prompt until we get a valid response for file and return what to
+    do: ("add", file), ("ignore", line for .gitignore), ("delete", file)
+    or None. If file is a directory, the user can choose to have its
+    files put on queue."""
     global pass_on_this_path
 
-    if os.path.isdir(file):
+    # no stat() needed: git status ends directory names with "/", and
+    # list_files(), which already knows each entry's type, only returns
+    # files (or links, which git tracks like files)
+    is_dir = file.endswith("/")
+    if is_dir:
         print("it's a directory...")
-
+    # folders on the path that can be chosen with "p n" or "n" (git status
+    # paths always use "/" and end in "/" for a directory):
+    folders = file.rstrip("/").split("/")
+    if not is_dir:
+        folders.pop()  # remove file as an option
+
+    # take any response chosen in the editor now, so that one for a file
+    # we pass on is not left over for a later local_push():
+    preset = preset_responses.pop(file, None)
     if pass_on_this_path != None:
-        if file.find(pass_on_this_path) == 0:
+        if file.startswith(pass_on_this_path):
             print("pass on", file)
             return  # do nothing with this file
         else:  # we are past this folder, clear the prefix to be safe
             pass_on_this_path = None
 
-    inp = input("  " + file + ": [aixdph123...] ")
-    if inp == "a":
-        subprocess.run(["git", "add", get_root("/" + file)])
-    elif inp == "i":
-        add_to_gitignore("/" + file)
-    elif inp == "x":
-        name, ext = os.path.splitext(file)
-        if len(ext) < 1 or ext[0] != ".":
-            print("- this file has no extension, try again")
-            handle_untracked_file(file)
-        elif len(ext) > 0 and ext[-1] == "~":
-            add_to_gitignore("*~")
-        else:
-            add_to_gitignore("*" + ext)
-    elif inp == "d":
-        if not delete_after_confirm(file):
-            handle_untracked_file(file)
-    elif inp.find("p") == 0:
-        if len(inp) == 1:  # just "p": pass on this file
-            return
-        inp = inp[1:].strip()  # remove "p and spaces
-        if len(inp) == 0:  # just "p" and spaces: pass on this file
-            return
-        if not inp[0].isdigit():  # "p" and garbage, accept as "p"
-            return
-        inp = int(inp)
-        folders = []
-        while file != "":
-            head, tail = os.path.split(file)
-            folders.append(tail)
-            file = head
-        folders.reverse()
-        # only allow selection of a folder on path
-        if os.path.isfile(file):
-            folders.pop()  # remove file as an option
-        if len(folders) < inp:
-            print("- there are not", inp, "folders on path, try again")
-            handle_untracked_file(file)
+    while True:
+        inp = preset
+        preset = None  # if it is not valid, ask
+        if inp is None:
+            inp = input("  " + file + ": [aixdpeh123...] ")
+        if inp == "a":
+            return ("add", file)
+        elif inp == "i":
+            return ("ignore", "/" + file)
+        elif inp == "x":
+            ext = extension(file)
+            if len(ext) < 1:
+                print("- this file has no extension, try again")
+                continue
+            elif len(ext) > 0 and ext[-1] == "~":
+                return ("ignore", "*~")
+            else:
+                return ("ignore", "*" + ext)
+        elif inp == "d":
+            if is_dir:
+                print("- only files can be deleted; type RETURN to answer",
+                      "for each file in this directory")
+                continue
+            if not confirm("delete " + file):
+                continue
+            return ("delete", file)
+        elif inp.find("p") == 0:
+            if len(inp) == 1:  # just "p": pass on this file
+                return
+            inp = inp[1:].strip()  # remove "p and spaces
+            if len(inp) == 0:  # just "p" and spaces: pass on this file
+                return
+            if not inp.isdigit():  # "p" and garbage, accept as "p"
+                return
+            prefix = folder_prefix(folders, int(inp))
+            if prefix is None:
+                continue
+            pass_on_this_path = prefix
+        elif inp.isdigit():
+            prefix = folder_prefix(folders, int(inp))
+            if prefix is None:
+                continue
+            return ("ignore", "/" + prefix)
+        elif inp == "e":
+            files = [file] + list(queue)
+            edit_responses(files)
+            queue.clear()
+            queue.extend(files)
             return
-        del folders[inp : ]
-        pass_on_this_path = folders[0]
-        for folder in folders[1:]:
-            pass_on_this_path = os.path.join(pass_on_this_path, folder)
+        elif is_dir:
+            print("it's a directory...")
+            # it's a directory. Prompt for disposition of each file in the
+            # dir tree (before going on to the rest of the queue):
+            queue.extendleft(reversed(list_files(file)))
+        else:
+            print(UNMANAGED_RESPONSES)
+            continue
         return
-    elif inp.isdigit():
-        folders = []
-        while file != "":
-            head, tail = os.path.split(file)
-            folders.append(tail)
-            file = head
-        folders.reverse()
-        inp = int(inp)
-        # only allow selection of a folder on path:
-        if os.path.isfile(file):
-            folders.pop()  # remove file as an option
-        if len(folders) < inp:
-            print("- there are not", inp, "folders on path, try again")
-            handle_untracked_file(file)
-            return
-        del folders[inp : ]
-        path = folders[0]
-        for folder in folders[1:]:
-            path = os.path.join(path, folder)
-        add_to_gitignore("/" + path + "/")
-    elif os.path.isdir(file):
-        print("it's a directory...")
-        # it's a directory. Prompt for disposition of each file in the
-        # dir tree:
-        for (dirpath, dirnames, filenames) in os.walk(file):
-            for name in filenames:
-                handle_untracked_file(os.path.join(dirpath, name))
-    else:
-        print(UNMANAGED_RESPONSES)
-        handle_untracked_file(file)
-        
-
-def local_push():
-    sp = subprocess.run(["git", "commit", "-a", "--dry-run", "-m", "dry run"],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    dryrun = sp.stdout.decode("utf-8")
-    dryrunerr = sp.stderr.decode("utf-8")
-    untracked = find_untracked(dryrun + dryrunerr)
+
+
+def local_push(backup=None):
+    """backup, if any, is the Future of a make_backup() running while the
+    user answers prompts; no files are changed until it is finished.
+    Returns False if the user chose to stop because the backup failed."""
+    untracked = find_untracked(git_status())
+    # answers are carried out together with one "git add" and one write
+    # to .gitignore:
+    chosen = {"add": [], "ignore": [], "delete": []}
     if len(untracked) > 0:
         print("- found untracked files. Specify what to do:")
-        for file in untracked:
-            handle_untracked_file(file)
+        queue = collections.deque(untracked)
+        while queue:
+            action = handle_untracked_file(queue.popleft(), queue)
+            if action:
+                chosen[action[0]].append(action[1])
+    if backup:
+        try:
+            backup.result()
+        except Exception as exc:  # e.g. shutil.Error for files not copied
+            print("- backup failed:", exc)
+            if not confirm("commit without a complete backup"):
+                return False
+    for file in chosen["delete"]:
+        try:
+            os.remove(file)
+        except OSError as exc:
+            print("- could not delete " + file + ":", exc.strerror)
+    # add before ignoring: git add refuses a file that a new .gitignore
+    # line (e.g. from "x") already matches
+    add_files(chosen["add"])
+    write_gitignore(chosen["ignore"])
     subprocess.run(["git", "commit", "-a"])
+    return True
     
 
+# push() skips its fetch if one succeeded this recently (seconds); if the
+# remote moved since then, git push is rejected and we say why:
+FETCH_MAX_AGE = 60.0
+
+
+def fetch_marker():
+    """return the path of the file vc touches after each successful fetch
+    (not FETCH_HEAD: git rewrites that even when the fetch fails)"""
+    return os.path.join(get_root(), ".git", "vc-last-fetch")
+
+
+def fetched_recently():
+    """true if a fetch succeeded within FETCH_MAX_AGE seconds"""
+    try:
+        return time.time() - os.stat(fetch_marker()).st_mtime < FETCH_MAX_AGE
+    except OSError:
+        return False
+
+
+def fetch_succeeded():
+    try:
+        with open(fetch_marker(), "w"):
+            pass
+    except OSError:
+        pass  # e.g. .git is a file; we will just fetch every time
+
+
+def start_fetch(extra_fetch_args = []):
+    """start "git fetch" in the background. It runs without a terminal so
+    that it cannot ask for a password while we are prompting; if it needs
+    one, it fails and the caller runs "git fetch" again in the foreground."""
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0",
+               SSH_ASKPASS_REQUIRE="never")
+    return subprocess.Popen(["git", "fetch"] + extra_fetch_args,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, env=env,
+                            close_fds=False, start_new_session=True)
+
+
+def run_tee(command):
+    """run command, showing its output (stdout and stderr) as it arrives,
+    and return the output so it can be searched for known problems"""
+    print("- git output:")
+    lines = []
+    with subprocess.Popen(command, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          encoding="utf-8", errors="replace") as process:
+        for line in process.stdout:
+            print(line, end="", flush=True)
+            lines.append(line)
+    print("-----------------")
+    return "".join(lines)
+
+
 def push(args, extra_push_args = []):
     show_branch()
+    fetch = None
+    if len(args) == 1 and not fetched_recently():
+        fetch = start_fetch()  # fetch from remote while we work locally
     # allow either "vc push local" or just "vc push":
     if (len(args) == 2 and args[1] == "local") or len(args) == 1:
-        make_backup()
-        local_push()
+        # copy files to the backup while the user answers prompts:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if not local_push(executor.submit(make_backup)):
+                return
     if len(args) == 1:  # only do this if non-local
-        if confirm("push to remote repo"):
-            subprocess.run(["git", "fetch"])
-            sp = subprocess.run(["git", "status", "-sb"],
-                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            out = sp.stdout.decode("utf-8")
-            if out.find("behind") >= 0:
+        pushing = confirm("push to remote repo")
+        fetched = fetch is None or fetch.wait() == 0
+        if fetch and fetched:
+            fetch_succeeded()
+        if pushing:
+            if not fetched:
+                if subprocess.run(["git", "fetch"]).returncode == 0:
+                    fetch_succeeded()
+            counts = ahead_behind()
+            if counts and counts[1] > 0:  # behind the remote branch
                 print("- You must pull changes from the remote repo")
                 print("-     before you can push any local changes")
                 if confirm("pull from remote repo now"):
-                    sp = subprocess.run(["git", "pull"],
-                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    out = sp.stdout.decode("utf-8")
-                    print("- git output:\n", out, "-----------------")
+                    out = run_tee(["git", "pull"])
                     if out.find("Merge conflict") >= 0:
                         conflict_files = ""
                         lines = out.splitlines()
@@ -373,15 +735,20 @@ def push(args, extra_push_args = []):
                 else:
                     print("- local changes are not committed to remote repo")
                     return 
-            sp = subprocess.run(["git", "push"] + extra_push_args,
-                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            out = sp.stdout.decode("utf-8")            
-            print("- git output:\n", out, "-----------------")
-            if out.find("hint: Updates were rejected because the tip of " +
-                        "your current branch is behind") >= 0:
+            out = run_tee(["git", "push"] + extra_push_args)
+            # older git says "the tip of your current branch is behind",
+            # newer git "the remote contains work that you do not have
+            # locally" (the line break moves, so match only the start):
+            if out.find("rejected because the tip of your current " +
+                        "branch is behind") >= 0 or \
+               out.find("rejected because the remote contains work") >= 0:
                 # push failed. Give some advice:
                 print("- 'vc push' did not complete because your local repo")
                 print("-     is not up-to-date.")
+                if fetch is None:  # we relied on an earlier fetch
+                    if subprocess.run(["git", "fetch"]).returncode == 0:
+                        fetch_succeeded()
+                    print("- Run 'vc push' again to pull the new changes.")
             elif out.find(" denied to ") >= 0:
                 print("- If git(hub) is using the wrong account,",
                       "it may be because git")
@@ -402,10 +769,7 @@ def push(args, extra_push_args = []):
 
 def pull(args, extra_pull_args = []):
     show_branch()
-    sp = subprocess.run(["git", "pull"] + extra_pull_args,
-                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    out = sp.stdout.decode("utf-8")
-    print("- git output:\n", out, "-----------------")
+    out = run_tee(["git", "pull"] + extra_pull_args)
     if out.find("signing failed") >= 0:
         print("- if git tried to use the wrong account or userid for this")
         print("-   project, edit the remote origini url in .git/config to")
@@ -421,30 +785,18 @@ def resolve(args):
                "resolved and you are ready to push changes to the repo.\n" + \
                conflict_files):
         conflict_files = conflict_files.splitlines()
-        command = ["git", "add"] + conflict_files
-        sp = subprocess.run(command, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-        out = sp.stdout.decode("utf-8")
-        print("- git output;\n", out, "----------------")
-        sp = subprocess.run(["git", "commit", "-a"], stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-        out = sp.stdout.decode("utf-8")
-        print("- git output;\n", out, "----------------")
-        sp = subprocess.run(["git", "rebase", "--continue"], stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-        out = sp.stdout.decode("utf-8")
-        print("- git output;\n", out, "----------------")
-        sp = subprocess.run(["git", "push"], stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-        out = sp.stdout.decode("utf-8")
-        print("- git output;\n", out, "----------------")
+        run_tee(["git", "add"] + conflict_files)
+        # commit and rebase may open an editor, so they get the terminal:
+        subprocess.run(["git", "commit", "-a"])
+        subprocess.run(["git", "rebase", "--continue"])
+        run_tee(["git", "push"])
         print("- files with conflicts that you resolved have been pushed " + \
               "to the repo")
         os.remove("files_with_conflicts.txt")
 
 
 def showinfo(args):
-    subprocess.run(["git", "status"])
+    run(["git", "status"])
 
 
 # git@github.com-rbdannenberg:rbdannenberg/pm_csharp.git
@@ -457,41 +809,66 @@ def newrepo(args):
     if not confirm("create local repo and initial check in"):
         print("- vc new command exited without any changes.")
         return
-    subprocess.run(["git", "init"])
-    # rename master to main -- less offensive, more compatible with github
-    subprocess.run(["git", "checkout", "-b", "main"])
+    # name the branch main -- less offensive, more compatible with github.
+    # "git init -b" does this in one command but needs git 2.28 or later:
+    sp = run(["git", "init", "-b", "main"], stderr=subprocess.DEVNULL)
+    if sp.returncode != 0:
+        run(["git", "init"])
+        run(["git", "checkout", "-b", "main"])
     local_push()
     url = input("URL for remote repository (you may need a URL in the\n" +
                 "    form git@github.com-<userid>:<userid>/<repo>.git: ")
-    subprocess.run(["git", "remote", "add", "origin", url])
-    subprocess.run(["git", "fetch", "--all"])
-    subprocess.run(["git", "branch", "--set-upstream-to=origin/main", "main"])
+    run(["git", "remote", "add", "origin", url])
+    # origin is the only remote; fetch it while the user thinks about README:
+    fetch = start_fetch(["origin"])
+    want_readme = not os.path.isfile("README.md") and \
+        confirm("create README.md if the remote repo has none (optional)")
+    if fetch.wait() != 0:
+        subprocess.run(["git", "fetch", "origin"])
+    run(["git", "branch", "--set-upstream-to=origin/main", "main"])
     # in case there are files already, e.g. license or README.md, pull them in
     pull([], extra_pull_args=["--allow-unrelated-histories"])
-    if not os.path.isfile("README.md"):
-        if confirm("create README.md (optional)"):
-            with open("README.md", "w") as readme:
-                readme.write("# " + url)
-            subprocess.run(["git", "add", "README.md"])
-            subprocess.run(["git", "commit", "-m", "created README.md"])
+    if want_readme and not os.path.isfile("README.md"):
+        with open("README.md", "w") as readme:
+            readme.write("# " + url)
+        run(["git", "add", "README.md"])
+        subprocess.run(["git", "commit", "-m", "created README.md"])
     # subprocess.run(["git", "branch", "-M", "main"])
     push(["push"], extra_push_args=["--set-upstream", "origin", "main"])
 
 
+def derive_dir(url):
+    """get the directory name git clone would use from a URL, e.g.
+    git@github.com:rbdannenberg/soundcool.git -> soundcool"""
+    url = url.rstrip("/\\")
+    # scp-style URLs may have no "/" at all, e.g. host:soundcool.git, and
+    # Windows paths use "\", e.g. C:\repos\soundcool:
+    tail = url[max(url.rfind("/"), url.rfind(":"), url.rfind("\\")) + 1 : ]
+    return tail[ : -4] if tail.endswith(".git") else tail
+
+
+# options for "vc checkout" and the "git clone" options they stand for:
+CLONE_OPTIONS = {"--shallow": ["--depth=1"],
+                 "--partial": ["--filter=blob:none"]}
+
+
 def checkout(args):
-    """args are ['checkout', <repo url>, <local directory>, <branch>]"""
+    """args are ['checkout', <repo url>, <local directory>, <branch>],
+    optionally with --shallow or --partial after 'checkout'"""
+    clone_options = []
+    while len(args) > 1 and args[1].startswith("--"):
+        if args[1] not in CLONE_OPTIONS:
+            show_help()
+            print('COMMAND ERROR: unknown option "' + args[1] + '"')
+            exit()
+        clone_options += CLONE_OPTIONS[args[1]]
+        args = args[:1] + args[2:]
     if len(args) < 2:
         show_help()
         print('COMMAND ERROR: no URL given after "checkout"')
         exit()
     elif len(args) < 3:
-        url = urlparse(args[1])
-        path = url[2]
-        dir = os.path.split(path)
-        print("- found path components:", dir)
-        # get after "/" and before ".":
-        #     git@github.com:rbdannenberg/soundcool.git -> soundcool
-        dir = dir[-1].split(".")[0]
+        dir = derive_dir(args[1])
         print("- derived '" + dir + "' as local directory")
         if os.path.exists(dir):
             print("-", dir, "already exists, checkout cancelled")
@@ -505,15 +882,8 @@ def checkout(args):
     if os.path.isdir(dir):
         raise Exception("Directory already exists: " + dir)
     if len(args) == 4:
-        sp = subprocess.run(["git", "clone", "-b", args[3], args[1], dir],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    else:
-        sp = subprocess.run(["git", "clone", args[1], dir],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out = sp.stdout.decode("utf-8")
-    print(out)
-    out = sp.stderr.decode("utf-8")
-    print(out)
+        clone_options += ["-b", args[3]]
+    out = run_tee(["git", "clone"] + clone_options + [args[1], dir])
     if out.find("Could not resolve hostname") >= 0:
         print("- Check status of Internet access")
 
@@ -524,7 +894,7 @@ def rename(args):
             print("- rename " + args[1] + " to " + args[2])
         else:
             print("- move " + args[1:-1] + " to " + args[-1])
-        subprocess.run(["git"] + args)
+        run(["git"] + args)
 
 
 def remove(args):
@@ -539,10 +909,14 @@ def remove(args):
     if not os.path.isfile(filename):
         print('- file ' + filename + ' does not exist')
         return
-    subprocess.run(["git", "rm", filename])
+    run(["git", "rm", filename])
 
 
-COMMANDS = ["push", "pull", "info", "new", "mv", "checkout", "rm", "resolve"]
-IMPLEMENTATIONS = [push, pull, showinfo, newrepo, rename, checkout, remove, resolve]
+DISPATCH = {"push": push, "pull": pull, "info": showinfo, "new": newrepo,
+            "mv": rename, "checkout": checkout, "rm": remove,
+            "resolve": resolve}
+# commands that run in an existing working directory (from its root):
+NEEDS_REPO = set(DISPATCH) - {"new", "checkout"}
 
-main()
+if __name__ == "__main__":
+    main()